@@ -5,23 +5,41 @@ import os
 import time
 from typing import List, Dict, Optional
 
+import numpy as np
+import orjson
 import streamlit as st
 
-# Vector DB / embeddings
-from langchain_chroma import Chroma
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain.schema import Document
-from chromadb import PersistentClient
+# LangChain interfaces only; heavy backends (torch, transformers, optimum, chromadb,
+# langchain_chroma, langchain_huggingface) are imported on first use inside the cached factories
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 
 # Ollama chat client (HTTP)
-from ollama import chat as ollama_chat
+from ollama import Client
 
 BASE_DIR = Path(__file__).parent.resolve()
 GENKI_PATH = BASE_DIR / "Data" / "Genki1.json"    # adjust if needed
 CHROMA_DIR = "./chroma_db"                  # db path
 COLLECTION_NAME = "genki"                         # explicit collection name
 EMBEDDING_MODEL = "intfloat/multilingual-e5-small"  # chose because of English and Japanese capabilities 
-OLLAMA_MODEL = "qwen3:1.7b"                       # set to any model you want
+EMBEDDING_ONNX_DIR = BASE_DIR / "e5_onnx_int8"      # int8 export of EMBEDDING_MODEL, built on first run
+COLLECTION_METADATA = {                           # HNSW index tuned for a few hundred–thousand chunks
+    "hnsw:space": "ip",                           # embeddings are L2-normalized, so inner product == cosine
+    "hnsw:M": 32,
+    "hnsw:construction_ef": 200,
+    "hnsw:search_ef": 64,
+}
+SNIPPET_CHARS = 750                               # max length of a source snippet in the Sources pane
+OLLAMA_MODEL = "qwen3:1.7b-q4_K_M"                # pinned quantized build (same weights `qwen3:1.7b` resolves to); set to any model you want
+RECENT_MESSAGES = 20                              # chat messages rendered per rerun; older ones only on request
+HISTORY_MESSAGES = 6                              # history sent to the model is trimmed in blocks of this many messages
+STREAM_REDRAW_SECS = 0.05                         # min interval between redraws of the streaming answer
+
+# Fixed system prompt always sent first, so Ollama can reuse its KV cache for the prompt prefix
+SYSTEM_MSG = {"role": "system", "content": (
+    "You are a helpful tutor assisting with Japanese grammar based on Genki textbook material. "
+    "Be clear, structured, and educational. Use bullet points and short examples with kana/kanji + romaji."
+)}
 
 # Optional: environment toggle to force a one-off reset without changing code
 FORCE_RESET = False
@@ -34,12 +52,15 @@ st.set_page_config(page_title="JLPT RAG Tutor (Genki)", page_icon="📘", layout
 # -----------------------
 # Helpers: lesson/sublesson extraction & filter 
 # -----------------------
+_LESSON_RE = re.compile(r"\blesson\s+(\d+)\b", re.IGNORECASE)
+_SUBLESSON_RE = re.compile(r"\bsublesson\s+(\d+)\b", re.IGNORECASE)
+
 def extract_lesson_info(text: str):
     result = {"lesson": None, "sublesson": None}
-    lesson_match = re.search(r"\blesson\s+(\d+)\b", text, re.IGNORECASE)
+    lesson_match = _LESSON_RE.search(text)
     if lesson_match:
         result["lesson"] = int(lesson_match.group(1))
-    sublesson_match = re.search(r"\bsublesson\s+(\d+)\b", text, re.IGNORECASE)
+    sublesson_match = _SUBLESSON_RE.search(text)
     if sublesson_match:
         result["sublesson"] = int(sublesson_match.group(1))
     return result
@@ -73,6 +94,137 @@ def build_effective_filter(user_text: str) -> dict | None:
     else:
         return None
 
+def sidebar_hint(sl, ssl) -> str:
+    # e.g. " (lesson 3, sublesson 2)" when sidebar filters aren't on "Auto"
+    hint_parts = []
+    if isinstance(sl, int):
+        hint_parts.append(f"lesson {sl}")
+    if isinstance(ssl, int):
+        hint_parts.append(f"sublesson {ssl}")
+    return f" ({', '.join(hint_parts)})" if hint_parts else ""
+
+
+
+# -----------------------
+# Embeddings: multilingual-e5 as a dynamically quantized int8 ONNX model
+# -----------------------
+def export_int8_embeddings(out_dir: Path = EMBEDDING_ONNX_DIR):
+    """Export EMBEDDING_MODEL to ONNX and dynamically quantize it to int8 (AVX512-VNNI kernels)."""
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+
+    model = ORTModelForFeatureExtraction.from_pretrained(EMBEDDING_MODEL, export=True)
+    qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+    ORTQuantizer.from_pretrained(model).quantize(save_dir=out_dir, quantization_config=qconfig)
+    AutoTokenizer.from_pretrained(EMBEDDING_MODEL).save_pretrained(out_dir)
+    print(f"✅ Exported int8 embedding model to '{out_dir}'.")
+
+class E5ORTEmbeddings(Embeddings):
+    """LangChain embeddings backed by the int8 ONNX export (mean pooling + L2 norm, same as the e5 sentence-transformer)."""
+
+    def __init__(self, model_dir: Path = EMBEDDING_ONNX_DIR, batch_size: int = 128):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(model_dir, file_name="model_quantized.onnx")
+        self.batch_size = batch_size
+
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = self.tokenizer(
+                texts[start:start + self.batch_size],
+                padding=True, truncation=True, max_length=512, return_tensors="np",
+            )
+            hidden = self.model(**batch).last_hidden_state
+            # mean pooling over real (non-padding) tokens, then L2 normalize
+            mask = batch["attention_mask"][..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            pooled /= np.linalg.norm(pooled, axis=1, keepdims=True)
+            vectors.extend(pooled.tolist())
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text])[0]
+
+class AutocastEmbeddings(Embeddings):
+    """Wraps a HuggingFaceEmbeddings so the forward pass runs under FP16 autocast on CUDA."""
+
+    def __init__(self, base: Embeddings):
+        self.base = base
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        import torch
+
+        with torch.inference_mode(), torch.autocast("cuda", dtype=torch.float16, enabled=torch.cuda.is_available()):
+            return self.base.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        import torch
+
+        with torch.inference_mode(), torch.autocast("cuda", dtype=torch.float16, enabled=torch.cuda.is_available()):
+            return self.base.embed_query(text)
+
+def quantize_int8(vectors: np.ndarray) -> np.ndarray:
+    """Round-trip unit vectors through symmetric per-vector int8 (scale = max|x| / 127) and re-normalize."""
+    scale = np.abs(vectors).max(axis=1, keepdims=True) / 127.0
+    scale[scale == 0] = 1.0
+    dequant = np.round(vectors / scale).astype(np.int8).astype(np.float32) * scale
+    return dequant / np.linalg.norm(dequant, axis=1, keepdims=True)
+
+class QuantizedE5Embeddings(Embeddings):
+    """Wraps an embedder so documents and queries both come out int8-quantization-equivalent.
+    Chroma still stores float32, but the HNSW graph is built in the quantized space, so the
+    index can later move to true int8 storage (e.g. FAISS IndexHNSWSQ8) without re-ranking drift.
+    """
+
+    def __init__(self, base: Embeddings):
+        self.base = base
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return quantize_int8(np.asarray(self.base.embed_documents(texts), dtype=np.float32)).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return quantize_int8(np.asarray([self.base.embed_query(text)], dtype=np.float32))[0].tolist()
+
+def get_embedding_device() -> str:
+    import torch
+
+    if torch.cuda.is_available():
+        return "cuda"
+    if torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+def _hf_embeddings(dev: str):
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    return HuggingFaceEmbeddings(
+        model_name=EMBEDDING_MODEL,
+        model_kwargs={"device": dev},
+        encode_kwargs={"batch_size": 128, "normalize_embeddings": True, "convert_to_numpy": True},
+    )
+
+def get_ingest_embeddings():
+    """Embedder for the one-time bulk ingest.
+    On CUDA the transformer is also torch.compile'd: the compile cost pays off over the whole
+    corpus but not for single queries, so the cached query embedder stays uncompiled.
+    Elsewhere this is just the query embedder (int8 ONNX on CPU).
+    """
+    if get_embedding_device() != "cuda":
+        return get_embeddings()
+    import torch
+
+    emb = _hf_embeddings("cuda")
+    st_model = emb._client  # the underlying SentenceTransformer
+    st_model[0].auto_model = torch.compile(st_model[0].auto_model, dynamic=True)
+    return QuantizedE5Embeddings(AutocastEmbeddings(emb))
+
 
 
 # -----------------------
@@ -80,20 +232,42 @@ def build_effective_filter(user_text: str) -> dict | None:
 # -----------------------
 @st.cache_resource(show_spinner=False)
 def get_embeddings():
-    return HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL)
+    # GPU / Apple silicon: full-precision model on the accelerator (FP16 autocast on CUDA)
+    dev = get_embedding_device()
+    if dev != "cpu":
+        return QuantizedE5Embeddings(AutocastEmbeddings(_hf_embeddings(dev)))
+
+    # CPU: int8 ONNX export
+    if not (EMBEDDING_ONNX_DIR / "model_quantized.onnx").exists():
+        export_int8_embeddings(EMBEDDING_ONNX_DIR)
+    return QuantizedE5Embeddings(E5ORTEmbeddings(EMBEDDING_ONNX_DIR))
 
 @st.cache_resource(show_spinner=False)
 def get_client():
+    from chromadb import PersistentClient
+
     return PersistentClient(path=CHROMA_DIR)
 
+@st.cache_resource(show_spinner=False)
+def get_vectordb():
+    from langchain_chroma import Chroma
+
+    return Chroma(
+        client=get_client(),  # share the cached PersistentClient instead of opening a second one
+        collection_name=COLLECTION_NAME,
+        embedding_function=get_embeddings(),
+        collection_metadata=COLLECTION_METADATA,
+    )
+
 @st.cache_resource(show_spinner=True)
 def init_and_ingest_if_needed(force_reset: bool = False):
     """One-time per server process:
     - Optionally delete the collection (force_reset)
     - Check if collection has vectors; if empty, ingest from GENKI_PATH
-    - Return nothing; we re-open vectordb on demand in retrieval
+    - Return nothing; retrieval reuses the cached vectordb handle
+    The embedding model (and torch/optimum) is only loaded here when ingest actually runs;
+    otherwise the first retrieval loads it.
     """
-    emb = get_embeddings()
     client = get_client()
 
     # Optional reset (drop only the collection)
@@ -113,8 +287,7 @@ def init_and_ingest_if_needed(force_reset: bool = False):
         existing_count = 0
 
     if existing_count == 0:
-        with open(GENKI_PATH, "r", encoding="utf-8") as f:
-            genki_chunks = json.load(f)
+        genki_chunks = orjson.loads(GENKI_PATH.read_bytes())
 
         # Convert JSON to LangChain Documents while preserving metadata (for filtering)
         docs: List[Document] = []
@@ -126,15 +299,18 @@ def init_and_ingest_if_needed(force_reset: bool = False):
                     "sublesson": chunk["sublesson"],
                     "topic": chunk["topic"],
                     "chunk_id": chunk["chunk_id"],
+                    "snippet": make_snippet(chunk["text"]),
                 },
             ))
 
-        # Store embeddings in ChromaDB
-        _vectordb = Chroma.from_documents(
-            documents=docs,
-            embedding=emb,
-            persist_directory=CHROMA_DIR,
-            collection_name=COLLECTION_NAME,
+        # Embed every chunk in batches, then store them in ChromaDB with a single add
+        texts = [d.page_content for d in docs]
+        embeddings = get_ingest_embeddings().embed_documents(texts)
+        client.get_or_create_collection(COLLECTION_NAME, metadata=COLLECTION_METADATA).add(
+            ids=[str(d.metadata["chunk_id"]) for d in docs],
+            embeddings=embeddings,
+            documents=texts,
+            metadatas=[d.metadata for d in docs],
         )
         print("✅ ChromaDB populated and saved.")
     else:
@@ -142,47 +318,80 @@ def init_and_ingest_if_needed(force_reset: bool = False):
 
 
 
+@st.cache_data(show_spinner=False, max_entries=256)
+def _embed_query(query: str) -> List[float]:
+    return get_embeddings().embed_query(query)
+
+
+
 # -----------------------
-# Retrieval helper (open an existing collection and search)
+# Retrieval helper (search the cached collection handle)
 # -----------------------
+def search_chunks(query: str, qfilter: Optional[dict], k: int) -> List[Document]:
+    """Search plans (both a single Chroma query):
+    - no filter: approximate HNSW search over the whole collection
+    - lesson filter: Chroma pre-filters on metadata first; small filtered sets (a lesson's
+      handful of chunks) are scored by brute force over just those rows, large ones via HNSW
+    """
+    vectordb = get_vectordb()
+    vec = _embed_query(query)
+    if not qfilter:
+        return vectordb.similarity_search_by_vector(vec, k=k)
+    return vectordb.similarity_search_by_vector(vec, k=k, filter=qfilter)
+
+@st.cache_data(show_spinner=False, max_entries=128)
+def _cached_retrieve(query: str, filter_key: str, k: int):
+    # the filter travels as sorted JSON so equivalent dicts share a key; results are kept as
+    # lightweight (page_content, metadata) pairs rather than Document objects
+    docs = search_chunks(query, json.loads(filter_key), k)
+    return tuple((d.page_content, d.metadata) for d in docs)
+
 def retrieve_chunks(query: str, k: int = 3):
-    emb = get_embeddings()
-    vectordb = Chroma(
-        persist_directory=CHROMA_DIR,
-        collection_name=COLLECTION_NAME,
-        embedding_function=emb,
-    )
     qfilter = build_effective_filter(query)
-    return (vectordb.similarity_search(query, k=k, filter=qfilter)
-            if qfilter else
-            vectordb.similarity_search(query, k=k))
+    filter_key = json.dumps(qfilter, sort_keys=True)
+    return [Document(page_content=text, metadata=dict(meta))
+            for text, meta in _cached_retrieve(query, filter_key, k)]
 
 
 
 # -----------------------
 # Chat with Ollama (stateful messages + streaming)
 # -----------------------
+# One client per process (cached across reruns): reuses the HTTP keep-alive connection to the daemon
+@st.cache_resource(show_spinner=False)
+def get_ollama_client():
+    return Client(host=os.environ.get("OLLAMA_HOST", "http://127.0.0.1:11434"), timeout=120)
+
 def stream_chat_answer(messages: List[Dict[str, str]], model: str):
     """Yield tokens as they arrive from Ollama's chat stream (for the given model)."""
-    stream = ollama_chat(model=model, messages=messages, stream=True)
+    # keep_alive stops the daemon from unloading the model weights between turns
+    stream = get_ollama_client().chat(
+        model=model,
+        messages=messages,
+        stream=True,
+        options={"num_ctx": 4096},
+        keep_alive="30m",
+    )
     for chunk in stream:
         yield chunk["message"]["content"]
 
+def make_snippet(text: str) -> str:
+    """Single-line display snippet for the Sources pane (computed once per chunk at ingest)."""
+    snippet = (text or "").strip().replace("\n", " ")
+
+    # cap at SNIPPET_CHARS (750) characters
+    return snippet[:SNIPPET_CHARS] + "..." if len(snippet) > SNIPPET_CHARS else snippet
+
 def build_sources(results):
     srcs = []
     for r in results:
         meta = r.metadata or {}
-        snippet = (r.page_content or "").strip().replace("\n", " ")
-
-        # cap at 500 characters
-        if len(snippet) > 750:
-            snippet = snippet[:750] + "..."
-
         srcs.append({
             "lesson": meta.get("lesson"),
             "sublesson": meta.get("sublesson"),
             "topic": meta.get("topic"),
-            "snippet": snippet,
+            # collections ingested before snippets were stored fall back to computing it here
+            "snippet": meta.get("snippet") or make_snippet(r.page_content),
         })
     return srcs
 
@@ -209,8 +418,10 @@ _ = init_and_ingest_if_needed(force_reset=FORCE_RESET)
 
 # Handle manual reset via sidebar
 if reset_clicked:
-    # Clear caches and re-init
-    st.cache_resource.clear()
+    # Clear only collection-level caches; the Chroma client and embedding model stay loaded
+    init_and_ingest_if_needed.clear()
+    get_vectordb.clear()
+    _cached_retrieve.clear()
     st.success("Collection reset requested. Re-initializing…")
     # Recreate and ingest
     _ = init_and_ingest_if_needed(force_reset=True)
@@ -221,13 +432,9 @@ if reset_clicked:
 # -----------------------
 # Session state for chat
 # -----------------------
+# Visible transcript: user/assistant turns only
 if "messages" not in st.session_state:
-    st.session_state.messages = [
-        {"role": "system", "content": (
-            "You are a helpful tutor assisting with Japanese grammar based on Genki textbook material. "
-            "Be clear, structured, and educational. Use bullet points and short examples with kana/kanji + romaji."
-        )}
-    ]
+    st.session_state.messages = []
 
 
 
@@ -258,7 +465,7 @@ with st.expander("ℹ️ About this app"):
             - If the Chroma collection is empty, the app ingests from your `Genki1.json` once.
             - Use the sidebar button to wipe & rebuild the collection.
             - To force a reset at startup: `FORCE_RESET=1 streamlit run streamlit_app.py`.
-            - Ensure the **Ollama daemon** is running (`ollama serve`) and the model is available (`ollama pull qwen3:1.7b`).
+            - Ensure the **Ollama daemon** is running (`ollama serve`) and the model is available (`ollama pull qwen3:1.7b-q4_K_M`).
             - **Textbook** selector in sidebar is UI‑only for now; we will wire it into metadata later.
             """
         )
@@ -268,19 +475,27 @@ with st.expander("ℹ️ About this app"):
 # -----------------------
 # Display conversation
 # -----------------------
-for msg in st.session_state.messages:
-    if msg["role"] == "system":
-        continue
+def render_sources(sources: List[Dict], key: str):
+    # a toggle (not an expander) so the snippets aren't built at all unless asked for
+    if st.toggle(f"📚 Sources ({len(sources)})", key=key):
+        for i, s in enumerate(sources, 1):
+            with st.expander(f"Source {i}: Lesson {s['lesson']} Sub {s['sublesson']} — {s['topic']}", expanded=False):
+                st.markdown(s["snippet"])
+
+def render_message(msg: Dict, idx: int):
     with st.chat_message("user" if msg["role"] == "user" else "assistant"):
         st.markdown(msg["content"]) 
 
          # 📚 Persistent Sources
         if "sources" in msg and msg["sources"]:
-            with st.expander(f"📚 Sources ({len(msg['sources'])})", expanded=False):
-                for i, s in enumerate(msg["sources"], 1):
-                    # Nested expander for the full snippet (optional)
-                    with st.expander(f"Source {i}: Lesson {s['lesson']} Sub {s['sublesson']} — {s['topic']}", expanded=False):
-                        st.markdown(s["snippet"])
+            render_sources(msg["sources"], key=f"sources_{idx}")
+
+n_older = max(0, len(st.session_state.messages) - RECENT_MESSAGES)
+# a toggle (not an expander) so older turns aren't built at all unless asked for
+show_older = n_older and st.toggle(f"Show earlier messages ({n_older})", key="show_earlier")
+for idx, msg in enumerate(st.session_state.messages):
+    if idx >= n_older or show_older:
+        render_message(msg, idx)
 
 
 
@@ -293,53 +508,54 @@ if user_input:
     # Retrieve context from vector DB
     with st.spinner("Searching Genki notes…"):
         results = retrieve_chunks(user_input, k=3)
-        context = "\n\n".join([r.page_content for r in results])
+        context = "\n\n".join(r.page_content for r in results)
 
     # Filter from sidebar if not defaults
-    hint_parts = []
-    sl = st.session_state.get("sidebar_lesson")
-    ssl = st.session_state.get("sidebar_sublesson")
-    if isinstance(sl, int):
-        hint_parts.append(f"lesson {sl}")
-    if isinstance(ssl, int):
-        hint_parts.append(f"sublesson {ssl}")
-    hint_txt = f" ({', '.join(hint_parts)})" if hint_parts else ""
+    hint_txt = sidebar_hint(st.session_state.get("sidebar_lesson"), st.session_state.get("sidebar_sublesson"))
+
+    # Working prompt for the model: system prompt + history form a prefix that only grows between
+    # trims (so Ollama can reuse its KV cache); this turn's context rides in the final user message.
+    # Old history is dropped in whole blocks, not a per-turn sliding window, so the prefix stays stable.
+    msgs = st.session_state.messages
+    start = max(0, (len(msgs) // HISTORY_MESSAGES - 1) * HISTORY_MESSAGES)
+    history = [{"role": m["role"], "content": m["content"]} for m in msgs[start:]]
+    working_msgs = [
+        SYSTEM_MSG,
+        *history,
+        {"role": "user", "content": f"Retrieved context:\n{context}\n\nQuestion{hint_txt}: {user_input}"},
+    ]
 
     # Visible transcript: show user's message first
     st.session_state.messages.append({"role": "user", "content": user_input})
     with st.chat_message("user"):
         st.markdown(user_input)
 
-    # Working prompt for the model (include retrieved context)
-    user_msg = f"Context:\n{context}\n\nQuestion{hint_txt}: {user_input}"
-    working_msgs = list(st.session_state.messages)
-    working_msgs.append({"role": "user", "content": user_msg})
-
     # Stream assistant answer
     with st.chat_message("assistant"):
         placeholder = st.empty()
         accum = ""
+        last_draw = 0.0
         try:
             for token in stream_chat_answer(working_msgs, OLLAMA_MODEL):
                 accum += token
-                placeholder.markdown(accum)
+                # each redraw resends the whole answer, so throttle instead of drawing every token
+                now = time.monotonic()
+                if now - last_draw > STREAM_REDRAW_SECS:
+                    placeholder.markdown(accum)
+                    last_draw = now
         except Exception as e:
             st.error(f"Ollama streaming error: {e}")
+        placeholder.markdown(accum)
 
     # Commit assistant message to history
     if accum:
+        sources = build_sources(results)
         st.session_state.messages.append({
             "role": "assistant",
             "content": accum,
-            "sources": build_sources(results),  # attach sources here
+            "sources": sources,  # attach sources here
         })
 
-        with st.expander(f"📚 Sources ({len(results)})", expanded=False):
-            for i, r in enumerate(results, 1):
-                with st.expander(
-                    f"Source {i}: Lesson {r.metadata['lesson']} Sub {r.metadata['sublesson']} — {r.metadata['topic']}",
-                    expanded=False,
-                ):
-                    snippet = (r.page_content or "").strip().replace("\n", " ")
-                    st.markdown(snippet[:750] + "…")
+        # same key the message gets when it is re-rendered from history on the next rerun
+        render_sources(sources, key=f"sources_{len(st.session_state.messages) - 1}")
 